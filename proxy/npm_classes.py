@@ -1,9 +1,12 @@
 """Utility classes to store NPM packge info downloaded from DevOps"""
 
 from dataclasses import dataclass, field
+from typing import Final
 
+LICENSE: Final[str] = "proprietary"
 
-@dataclass
+
+@dataclass(slots=True)
 class NpmPackageVersion:
     """Stores info about a specific version of a NPM package from DevOps"""
 
@@ -23,10 +26,51 @@ class NpmPackageVersion:
     hide_in_editor: bool = True
 
 
-@dataclass
+@dataclass(slots=True)
 class NpmPackage:
     """Stores info about a NPM package from DevOps"""
 
     name: str
     latest_version: str
     versions: dict[str, NpmPackageVersion] = field(default_factory=dict)
+
+
+def to_mongo(package: NpmPackage) -> dict:
+    """
+    Convert a package to a Mongo document. Much faster than `dataclasses.asdict`,
+    as the (already flat) versions aren't recursively copied via reflection
+    """
+
+    return {
+        "name": package.name,
+        "latest_version": package.latest_version,
+        "versions": {
+            version.version_number: {
+                field_name: getattr(version, field_name)
+                for field_name in version.__slots__
+            }
+            for version in package.versions.values()
+        },
+    }
+
+
+def to_latest_view(package: NpmPackage) -> dict:
+    """
+    Summarise the latest version of a package, in the form the proxy serves it from
+    `/-/all`
+    """
+
+    latest_version = package.versions[package.latest_version]
+
+    return {
+        "name": package.name,
+        "description": latest_version.description,
+        "dist-tags": {"latest": latest_version.version_number},
+        "license": LICENSE,
+        "time": latest_version.publish_date,
+        "versions": {latest_version.version_number: "latest"},
+        "displayName": latest_version.display_name,
+        "unity": latest_version.unity,
+        "category": latest_version.category,
+        "hideInEditor": latest_version.hide_in_editor,
+    }
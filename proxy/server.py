@@ -1,22 +1,48 @@
 """NPM metadata proxy server"""
 
-from collections import OrderedDict
+from itertools import chain
 import logging
 import os
-import random
-import string
+from secrets import token_hex
+import threading
 import time
+from typing import Final
 
-import dacite
+from cachetools import TTLCache
+import cattrs
+from cattrs.gen import make_dict_structure_fn
+import orjson
 
-from flask import Flask, make_response, jsonify
+from flask import Flask, Response, make_response, jsonify, stream_with_context
+from flask_orjson import OrjsonProvider
 from flask_pymongo import PyMongo
+from pymongo.errors import PyMongoError
 
-from npm_classes import NpmPackage
+from npm_classes import LICENSE, NpmPackage, NpmPackageVersion
 
-LICENSE = "proprietary"
+# How long (in seconds) a serialised response is served from memory before it
+# is rebuilt from Mongo
+RESPONSE_CACHE_TTL: Final[int] = 60
+
+# How many bytes of serialised responses each server process may keep in memory
+RESPONSE_CACHE_BYTES: Final[int] = 64 * 1024 * 1024
+
+# Cache key for `/-/all`. `/<package_name>` can never match a `/`, so no request
+# for a package can read this entry
+ALL_PACKAGES_CACHE_KEY: Final[str] = "-/all"
+
+# How many packages to pull from Mongo per round trip when streaming `/-/all`
+ALL_PACKAGES_BATCH_SIZE: Final[int] = 500
+
+# The scraper stores a ready-to-serve summary of each package's latest version
+ALL_PACKAGES_PROJECTION: Final[dict[str, int]] = {"_id": 0, "latest_view": 1}
+
+# `/<package_name>` builds its response from the versions, so skip the summary
+PACKAGE_PROJECTION: Final[dict[str, int]] = {"_id": 0, "latest_view": 0}
 
 app = Flask(__name__)
+# orjson never indents, so responses stay compact even in debug mode
+app.json = OrjsonProvider(app)
 
 MONGO_HOST = os.environ.get("MONGO_HOST", "mongo")
 MONGO_PORT = os.environ.get("MONGO_PORT", 27017)
@@ -24,14 +50,32 @@ MONGO_USER = os.environ.get("MONGO_USER")
 MONGO_PASS = os.environ.get("MONGO_PASS")
 MONGO_DB = os.environ.get("MONGO_DB")
 
-app.config["JSON_SORT_KEYS"] = False
-app.config[
-    "MONGO_URI"
+MONGO_URI: Final[
+    str
 ] = f"mongodb://{MONGO_USER}:{MONGO_PASS}@{MONGO_HOST}:{MONGO_PORT}/{MONGO_DB}"
 
+app.config["MONGO_URI"] = MONGO_URI
+
 mongo = PyMongo(app, authSource="admin")
 db = mongo.db
 
+# Generate (de)serialisation code for the NPM classes once, up front
+converter = cattrs.GenConverter()
+# Strings are stored as-is in Mongo; don't coerce missing values to "None"
+converter.register_structure_hook(str, lambda value, _: value)
+
+for npm_class in (NpmPackageVersion, NpmPackage):
+    converter.register_structure_hook(
+        npm_class, make_dict_structure_fn(npm_class, converter)
+    )
+
+# Serialised JSON responses, keyed by package name. Limited by total size in bytes,
+# as a single package can be several MB
+response_cache = TTLCache(
+    maxsize=RESPONSE_CACHE_BYTES, ttl=RESPONSE_CACHE_TTL, getsizeof=len
+)
+response_cache_lock = threading.Lock()
+
 logging.basicConfig(
     level=logging.INFO,
     format="[%(asctime)s.%(msecs)03d] %(levelname)s [%(funcName)s] %(message)s",
@@ -39,6 +83,38 @@ logging.basicConfig(
 )
 
 
+def get_cached_response(key: str) -> Response | None:
+    """Returns a previously serialised JSON response, if it hasn't expired"""
+
+    with response_cache_lock:
+        body = response_cache.get(key)
+
+    if body is None:
+        return None
+
+    return Response(body, mimetype="application/json")
+
+
+def cache_response_body(key: str, body: bytes | bytearray):
+    """Stores a serialised JSON response in the cache"""
+
+    # Too big to ever fit in the cache; just don't cache it
+    if len(body) > RESPONSE_CACHE_BYTES:
+        return
+
+    with response_cache_lock:
+        response_cache[key] = body
+
+
+def cache_response(key: str, obj) -> Response:
+    """Serialises `obj` to JSON, caches it and returns it as a response"""
+
+    body = orjson.dumps(obj)
+    cache_response_body(key, body)
+
+    return Response(body, mimetype="application/json")
+
+
 @app.route("/")
 def index_route():
     """Home route"""
@@ -51,15 +127,20 @@ def package_route(package_name: str):
     Returns all info (incl. versions) about a specific package from Mongo
     """
 
-    mongo_package = db.packages.find_one({"name": package_name})
+    cached_response = get_cached_response(package_name)
+
+    if cached_response is not None:
+        return cached_response
+
+    mongo_package = db.packages.find_one({"name": package_name}, PACKAGE_PROJECTION)
 
     if mongo_package is None:
         return make_response(jsonify(error="Not found"), 404)
 
     try:
         # Auto-magically convert dict to `npm_package`
-        package = dacite.from_dict(data_class=NpmPackage, data=mongo_package)
-    except dacite.WrongTypeError as err:
+        package = converter.structure(mongo_package, NpmPackage)
+    except cattrs.BaseValidationError as err:
         logging.error(
             "Could not deserialise package '%s' from Mongo. Reason: %s",
             package_name,
@@ -69,54 +150,46 @@ def package_route(package_name: str):
 
     latest_version = package.versions[package.latest_version]
 
-    all_versions = OrderedDict()
-    version_times = OrderedDict()
+    all_versions = {}
+    version_times = {}
 
     for _, version in package.versions.items():
         version_times[version.version_number] = version.publish_date
 
-        all_versions[version.version_number] = OrderedDict(
-            {
-                "_id": f"{package_name}@{version.version_number}",
-                "_shasum": version.shasum,
-                "name": package_name,
-                "author": version.author,
-                "dependencies": version.dependencies,
-                "description": version.description,
-                "directories": None,
-                "dist": OrderedDict(
-                    {"shasum": version.shasum, "tarball": version.tarball}
-                ),
-                "license": LICENSE,
-                "version": version.version_number,
-                "displayName": version.display_name,
-                "unity": version.unity,
-                "category": version.category,
-                "hideInEditor": version.hide_in_editor,
-            }
-        )
-
-    response = OrderedDict(
-        {
-            "_id": package_name,
-            "_rev": "".join(
-                random.choices(string.ascii_lowercase + string.digits, k=32)
-            ),
+        all_versions[version.version_number] = {
+            "_id": f"{package_name}@{version.version_number}",
+            "_shasum": version.shasum,
             "name": package_name,
-            "description": latest_version.description,
+            "author": version.author,
+            "dependencies": version.dependencies,
+            "description": version.description,
+            "directories": None,
+            "dist": {"shasum": version.shasum, "tarball": version.tarball},
             "license": LICENSE,
-            "dist-tags": {"latest": latest_version.version_number},
-            "versions": all_versions,
-            "time": version_times,
-            "displayName": latest_version.display_name,
-            "unity": latest_version.unity,
-            "category": latest_version.category,
-            "hideInEditor": latest_version.hide_in_editor,
-            "author": latest_version.author,
+            "version": version.version_number,
+            "displayName": version.display_name,
+            "unity": version.unity,
+            "category": version.category,
+            "hideInEditor": version.hide_in_editor,
         }
-    )
 
-    return jsonify(response)
+    response = {
+        "_id": package_name,
+        "_rev": token_hex(16),
+        "name": package_name,
+        "description": latest_version.description,
+        "license": LICENSE,
+        "dist-tags": {"latest": latest_version.version_number},
+        "versions": all_versions,
+        "time": version_times,
+        "displayName": latest_version.display_name,
+        "unity": latest_version.unity,
+        "category": latest_version.category,
+        "hideInEditor": latest_version.hide_in_editor,
+        "author": latest_version.author,
+    }
+
+    return cache_response(package_name, response)
 
 
 @app.route("/-/all")
@@ -125,46 +198,69 @@ def all_packages_route():
     Returns basic info about all packages in Mongo
     """
 
-    all_packages = OrderedDict({"_updated": int(time.time())})
+    cached_response = get_cached_response(ALL_PACKAGES_CACHE_KEY)
 
-    mongo_packages = db.packages.find()
+    if cached_response is not None:
+        return cached_response
 
-    for mongo_package in mongo_packages:
-        try:
-            # Auto-magically convert dict to `npm_package`
-            package = dacite.from_dict(data_class=NpmPackage, data=mongo_package)
-        except dacite.WrongTypeError as err:
-            logging.error(
-                "Could not deserialise package from Mongo. Reason: %s",
-                err,
-            )
-            return make_response(
-                jsonify(err="Could not deserialise from database"), 500
+    mongo_packages = db.packages.find({}, ALL_PACKAGES_PROJECTION).batch_size(
+        ALL_PACKAGES_BATCH_SIZE
+    )
+
+    # Run the query before streaming starts, so a database error can still be a 500
+    try:
+        first_package = next(mongo_packages, None)
+    except PyMongoError as err:
+        logging.error("Could not read packages from Mongo. Reason: %s", err)
+        return make_response(jsonify(err="Could not read from database"), 500)
+
+    if first_package is not None:
+        mongo_packages = chain((first_package,), mongo_packages)
+
+    def generate_all_packages():
+        """Streams the JSON object one package at a time"""
+
+        # Everything streamed is also kept (once) so it can be cached afterwards
+        body = bytearray()
+
+        chunk = b'{"_updated":' + orjson.dumps(int(time.time()))
+        body += chunk
+        yield chunk
+
+        for mongo_package in mongo_packages:
+            latest_view = mongo_package.get("latest_view")
+
+            # Headers have already been sent, so the best we can do is skip it
+            if latest_view is None:
+                logging.error(
+                    "Package in Mongo has no latest version summary. Skipping it. Has the scraper run yet?"
+                )
+                continue
+
+            chunk = (
+                b","
+                + orjson.dumps(latest_view["name"])
+                + b":"
+                + orjson.dumps(latest_view)
             )
+            body += chunk
+            yield chunk
 
-        latest_version = package.versions[package.latest_version]
-
-        all_packages[package.name] = OrderedDict(
-            {
-                "name": package.name,
-                "description": latest_version.description,
-                "dist-tags": {"latest": latest_version.version_number},
-                "license": LICENSE,
-                "time": latest_version.publish_date,
-                "versions": {latest_version.version_number: "latest"},
-                "displayName": latest_version.display_name,
-                "unity": latest_version.unity,
-                "category": latest_version.category,
-                "hideInEditor": latest_version.hide_in_editor,
-            }
-        )
+        body += b"}"
+        yield b"}"
 
-    return jsonify(all_packages)
+        # Only cache the response once it has been streamed in full
+        cache_response_body(ALL_PACKAGES_CACHE_KEY, body)
+
+    return Response(
+        stream_with_context(generate_all_packages()), mimetype="application/json"
+    )
 
 
 if __name__ == "__main__":
     logging.info("Application start!")
 
     SERVER_PORT = os.environ.get("SERVER_PORT", 8080)
+    SERVER_DEBUG = os.environ.get("SERVER_DEBUG", "").lower() in ("1", "true", "yes")
 
-    app.run(host="0.0.0.0", port=SERVER_PORT, debug=True)
+    app.run(host="0.0.0.0", port=SERVER_PORT, debug=SERVER_DEBUG)
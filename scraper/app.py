@@ -1,24 +1,32 @@
 """Program to scrape NPM package metdata from DevOps"""
 
-import dataclasses
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 import datetime
 import sys
 import logging
+from typing import Final
 
 from apscheduler.schedulers.blocking import BlockingScheduler
-from pymongo import MongoClient, collection
+import orjson
+from pymongo import MongoClient, ReplaceOne, collection
+from pymongo.errors import OperationFailure
 
 from enums import MongoPackageStatus, NetworkError, ReturnStatus
 from environmental_variables import EnvironmentalVariables, process_env_vars
-from npm_classes import NpmPackage
+from npm_classes import NpmPackage, to_latest_view, to_mongo
 from devops_scraping import (
+    DOWNLOAD_WORKERS,
+    authenticate_devops_session,
     get_artifact_package_feed_from_devops,
-    get_extra_npm_info_from_devops_npm_registry,
     get_from_devops,
-    get_npm_versions_from_devops_feed,
+    get_package_versions_from_devops,
     validate_package_versions,
 )
-from mongo_functions import check_package_status_in_mongo
+from mongo_functions import (
+    check_package_status_in_mongo,
+    remove_duplicate_packages,
+    write_packages_to_mongo,
+)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -28,25 +36,22 @@ logging.basicConfig(
 
 sched = BlockingScheduler()
 
+# How many package uploads to send to Mongo in a single bulk write
+MONGO_BULK_WRITE_SIZE: Final[int] = 100
 
-def download(
-    env_vars: EnvironmentalVariables, packages_collection: collection.Collection
-):
+
+def submit_package_downloads(
+    executor: ThreadPoolExecutor,
+    env_vars: EnvironmentalVariables,
+    devops_package_list: list,
+    packages_collection: collection.Collection,
+) -> dict[Future, tuple[str, str]]:
     """
-    Downloads a list of packages from DevOps and processes them
+    Start downloading version info for every package that is missing or out of date
+    in Mongo. Returns the name and latest version of each package being downloaded
     """
 
-    devops_package_list_response = get_from_devops(
-        env_vars.packages_url, env_vars, "DevOps package list"
-    )
-
-    if isinstance(devops_package_list_response, NetworkError):
-        logging.error("Failed to download DevOps package list. Stopping this run")
-
-    devops_package_list: list = devops_package_list_response.json().get("value")
-
-    # Keep track of non-serious errors this run
-    non_serious_error_count = 0
+    package_downloads: dict[Future, tuple[str, str]] = {}
 
     for package_response in devops_package_list:
         # Read in info from repsonse
@@ -64,61 +69,153 @@ def download(
         if mongo_package_status == MongoPackageStatus.UP_TO_DATE:
             continue
 
-        # Download version info from DevOps Artifact package feed
-        package_versions = get_npm_versions_from_devops_feed(
-            package_version_url, env_vars
-        )
-
-        match validate_package_versions(
+        # Download version info from DevOps in the background
+        download_future = executor.submit(
+            get_package_versions_from_devops,
+            env_vars,
             package_name,
-            package_versions,
-            "DevOps Artifact feed",
-            "Here be dragons!",
-            non_serious_error_count,
-        ):
-            case ReturnStatus.RETURN:
-                return
-            case ReturnStatus.CONTINUE:
-                continue
-
-        # Download more version infor from DevOps NPM registry
-        package_versions = get_extra_npm_info_from_devops_npm_registry(
-            env_vars, package_name, package_versions
+            package_version_url,
         )
+        package_downloads[download_future] = (package_name, package_latest_version)
 
-        match validate_package_versions(
-            package_name,
-            package_versions,
-            "DevOps NPM registry",
-            "This is probably because all package versions only exist in DevOps Artifact feed, with none in the DevOps NPM registry",
-            non_serious_error_count,
-        ):
-            case ReturnStatus.RETURN:
-                return
-            case ReturnStatus.CONTINUE:
-                continue
-
-        new_package = NpmPackage(
+    return package_downloads
+
+
+def process_package_download(
+    download_future: Future,
+    package_name: str,
+    package_latest_version: str,
+    non_serious_error_count: int,
+) -> ReplaceOne | ReturnStatus:
+    """
+    Validate the version info downloaded for a package, and turn it into a Mongo
+    upload. Returns a `ReturnStatus` instead if the package shouldn't be uploaded
+    """
+
+    feed_versions, package_versions = download_future.result()
+
+    match validate_package_versions(
+        package_name,
+        feed_versions,
+        "DevOps Artifact feed",
+        "Here be dragons!",
+        non_serious_error_count,
+    ):
+        case ReturnStatus.RETURN:
+            return ReturnStatus.RETURN
+        case ReturnStatus.CONTINUE:
+            return ReturnStatus.CONTINUE
+
+    match validate_package_versions(
+        package_name,
+        package_versions,
+        "DevOps NPM registry",
+        "This is probably because all package versions only exist in DevOps Artifact feed, with none in the DevOps NPM registry",
+        non_serious_error_count,
+    ):
+        case ReturnStatus.RETURN:
+            return ReturnStatus.RETURN
+        case ReturnStatus.CONTINUE:
+            return ReturnStatus.CONTINUE
+
+    # The latest version can be missing from the DevOps NPM registry
+    if package_latest_version not in package_versions:
+        logging.warning(
+            "Package '%s', latest version %s was not found in DevOps NPM registry! This package will not be uploaded to Mongo",
             package_name,
             package_latest_version,
-            package_versions,
         )
+        return ReturnStatus.CONTINUE
 
-        # Delete the old version of the package on Mongo
-        # TODO: don't do this; update existing Mongo entry with new versions
-        if mongo_package_status == MongoPackageStatus.OUT_OF_DATE:
-            logging.info(
-                "Deleting package '%s' from Mongo as it is out of date", package_name
-            )
-            packages_collection.delete_one({"name": package_name})
+    new_package = NpmPackage(
+        package_name,
+        package_latest_version,
+        package_versions,
+    )
 
-        logging.info("Uploading package '%s' to Mongo", package_name)
+    logging.info("Queueing package '%s' for upload to Mongo", package_name)
 
-        # Upload package to Mongo
-        new_package_as_json = dataclasses.asdict(new_package)
-        packages_collection.insert_one(new_package_as_json)
+    # Upload package to Mongo, replacing the old version if it is out of date
+    new_package_as_json = to_mongo(new_package)
+    # Precompute what the proxy serves from `/-/all`, so it doesn't have to
+    new_package_as_json["latest_view"] = to_latest_view(new_package)
 
-    logging.info("Finished processing all packages on DevOps!")
+    return ReplaceOne({"name": package_name}, new_package_as_json, upsert=True)
+
+
+def download(
+    env_vars: EnvironmentalVariables, packages_collection: collection.Collection
+):
+    """
+    Downloads a list of packages from DevOps and processes them
+    """
+
+    devops_package_list_response = get_from_devops(
+        env_vars.packages_url, "DevOps package list"
+    )
+
+    if isinstance(devops_package_list_response, NetworkError):
+        logging.error("Failed to download DevOps package list. Stopping this run")
+
+    devops_package_list_json = orjson.loads(devops_package_list_response.content)
+    devops_package_list: list = devops_package_list_json.get("value")
+
+    # Keep track of non-serious errors this run
+    non_serious_error_count = 0
+
+    # Package uploads are batched up and sent to Mongo together
+    package_updates: list[ReplaceOne] = []
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        package_downloads = submit_package_downloads(
+            executor, env_vars, devops_package_list, packages_collection
+        )
+
+        for download_future in as_completed(package_downloads):
+            package_name, package_latest_version = package_downloads[download_future]
+
+            try:
+                package_update = process_package_download(
+                    download_future,
+                    package_name,
+                    package_latest_version,
+                    non_serious_error_count,
+                )
+            except Exception:  # pylint: disable=broad-except
+                # e.g. DevOps returned something that isn't the JSON we expect
+                non_serious_error_count += 1
+
+                logging.exception(
+                    "Unexpected error while downloading version info for package '%s'. This has happened %s time(s) this run",
+                    package_name,
+                    non_serious_error_count,
+                )
+
+                if non_serious_error_count == 5:
+                    logging.error(
+                        "A non-serious error has occurred 5 times. Stopping this run."
+                    )
+                    package_update = ReturnStatus.RETURN
+                else:
+                    package_update = ReturnStatus.CONTINUE
+
+            match package_update:
+                case ReturnStatus.RETURN:
+                    # Stop downloading, but still upload the packages that were
+                    # successfully processed
+                    executor.shutdown(cancel_futures=True)
+                    break
+                case ReturnStatus.CONTINUE:
+                    continue
+
+            package_updates.append(package_update)
+
+            if len(package_updates) >= MONGO_BULK_WRITE_SIZE:
+                write_packages_to_mongo(package_updates, packages_collection)
+        else:
+            logging.info("Finished processing all packages on DevOps!")
+
+    write_packages_to_mongo(package_updates, packages_collection)
 
 
 def main():
@@ -131,6 +228,8 @@ def main():
     env_vars.feed_url = f"https://feeds.dev.azure.com/{env_vars.org_name}/_apis/packaging/feeds/{env_vars.feed}?api-version=6.0-preview.1"
     env_vars.npm_registry_base_url = f"https://pkgs.dev.azure.com/{env_vars.org_name}/_packaging/{env_vars.feed}/npm/registry"
 
+    authenticate_devops_session(env_vars.pat)
+
     packages_url = get_artifact_package_feed_from_devops(env_vars)
 
     if isinstance(packages_url, NetworkError):
@@ -152,6 +251,18 @@ def main():
     if env_vars.wipe_db:
         packages_collection.drop()
 
+    # Packages are always looked up by name (by both the scraper and the proxy)
+    remove_duplicate_packages(packages_collection)
+
+    try:
+        packages_collection.create_index("name", unique=True)
+    except OperationFailure as err:
+        # Lookups by name still work without the index, just more slowly
+        logging.error(
+            "Failed to create index on package names. Continuing without it. Reason: %s",
+            err,
+        )
+
     # Continually download pacakges
     sched.add_job(
         id="Download latest NPM package info from DevOps",
@@ -1,15 +1,34 @@
 """Functions for scraping data from DevOps"""
 
 import base64
-from collections import OrderedDict
 import logging
+from typing import Final
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 
 from enums import NetworkError, ReturnStatus
 from environmental_variables import EnvironmentalVariables
 from npm_classes import NpmPackageVersion
 
+# How many packages to download from DevOps at the same time
+DOWNLOAD_WORKERS: Final[int] = 16
+
+# How many connections to DevOps to keep open for reuse. Each download worker only
+# makes one request at a time, so this is one connection per worker
+DEVOPS_CONNECTION_POOL_SIZE: Final[int] = DOWNLOAD_WORKERS
+
+# Shared between all requests so connections (and TLS sessions) to DevOps are reused
+devops_session = requests.Session()
+devops_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=DEVOPS_CONNECTION_POOL_SIZE,
+        pool_maxsize=DEVOPS_CONNECTION_POOL_SIZE,
+    ),
+)
+
 
 class DevOpsAuthToken(requests.auth.AuthBase):
     """
@@ -18,33 +37,37 @@ class DevOpsAuthToken(requests.auth.AuthBase):
     """
 
     def __init__(self, pat):
-        self.token = pat
+        # The PAT never changes, so neither does the header
+        token = base64.b64encode(f":{pat}".encode("utf-8")).decode("utf-8")
+        self.header = f"Basic {token}"
 
     def __call__(self, r):
-        r.headers["Authorization"] = "Basic " + base64.b64encode(
-            (f":{self.token}").encode("utf-8")
-        ).decode("utf-8")
+        r.headers["Authorization"] = self.header
         return r
 
 
+def authenticate_devops_session(pat: str):
+    """Authenticate every request made through `devops_session` with the given PAT"""
+
+    devops_session.auth = DevOpsAuthToken(pat)
+
+
 def get_from_devops(
     url: str,
-    env_vars: EnvironmentalVariables,
     description: str,
     request_timeout: int = 10,
 ) -> requests.Response | NetworkError:
     """
     Try to get data from DevOps.
 
-    Handles authentication, network and timeout errors
+    Handles network and timeout errors. Authentication is handled by `devops_session`
+    (see `authenticate_devops_session`)
     """
 
     request_failure_prefix = f"Failed to get {description}"
 
     try:
-        response = requests.get(
-            url, auth=DevOpsAuthToken(env_vars.pat), timeout=request_timeout
-        )
+        response = devops_session.get(url, timeout=request_timeout)
     except requests.exceptions.Timeout:
         logging.error("%s due to request exceeding timeout", request_failure_prefix)
         return NetworkError.TIMEOUT
@@ -55,27 +78,29 @@ def get_from_devops(
         logging.error("%s due to connection error", request_failure_prefix)
         return NetworkError.HTTP_ERROR
 
+    status_code = response.status_code
+
     # Authentication failure in DevOps returns 203 ¯\_(ツ)_/¯
-    if response.status_code == 203:
+    if status_code == 203:
         logging.error(
             "%s due to DevOps authentication error! Is the provided PAT valid and does it have the correct scopes?",
             request_failure_prefix,
         )
         return NetworkError.DEVOPS_AUTH_FAILURE
 
-    if response.status_code in range(400, 500):
+    if 400 <= status_code < 500:
         logging.error(
             "%s due to receiving HTTP status code %s",
             request_failure_prefix,
-            response.status_code,
+            status_code,
         )
         return NetworkError.STATUS_CLIENT_ERROR
 
-    if response.status_code in range(500, 600):
+    if 500 <= status_code < 600:
         logging.error(
             "%s due to receiving HTTP status code %s",
             request_failure_prefix,
-            response.status_code,
+            status_code,
         )
         return NetworkError.STATUS_SERVER_ERROR
 
@@ -88,58 +113,46 @@ def get_artifact_package_feed_from_devops(
     """Get actual artifact package feed (i.e. JSON document containing all packages)"""
 
     artifact_feed_response = get_from_devops(
-        env_vars.feed_url, env_vars, "DevOps Artifact feed URL"
+        env_vars.feed_url, "DevOps Artifact feed URL"
     )
 
     if isinstance(artifact_feed_response, NetworkError):
         return artifact_feed_response
 
     package_feed_url: str = (
-        artifact_feed_response.json().get("_links").get("packages").get("href")
+        orjson.loads(artifact_feed_response.content)
+        .get("_links")
+        .get("packages")
+        .get("href")
     )
 
     return package_feed_url
 
 
 def get_npm_versions_from_devops_feed(
-    package_version_url: str, env_vars: EnvironmentalVariables
+    package_version_url: str,
 ) -> dict[str, NpmPackageVersion] | NetworkError:
     """Get info for every version of a package from DevOps Artifact feed"""
 
-    devops_feed_response = get_from_devops(
-        package_version_url, env_vars, "DevOps Artifact feed"
-    )
+    devops_feed_response = get_from_devops(package_version_url, "DevOps Artifact feed")
 
     if isinstance(devops_feed_response, NetworkError):
         return devops_feed_response
 
-    devops_versions: list = devops_feed_response.json().get("value")
-
-    processed_versions: dict[str, NpmPackageVersion] = {}
-
-    for devops_version in devops_versions:
-        version_number: str = devops_version.get("version")
-        description: str = devops_version.get("description") or ""
-        publish_date: str = devops_version.get("publishDate")
-
-        dependencies = OrderedDict()
-
-        for dep in devops_version.get("dependencies"):
-            package_name: str = dep.get("packageName")
-            version_range: str = dep.get("versionRange")
-
-            dependencies[package_name] = version_range
-
-        new_version = NpmPackageVersion(
-            version_number=version_number,
-            description=description,
-            publish_date=publish_date,
-            dependencies=dependencies,
+    devops_versions: list = orjson.loads(devops_feed_response.content).get("value")
+
+    return {
+        devops_version.get("version"): NpmPackageVersion(
+            version_number=devops_version.get("version"),
+            description=devops_version.get("description") or "",
+            publish_date=devops_version.get("publishDate"),
+            dependencies={
+                dep.get("packageName"): dep.get("versionRange")
+                for dep in devops_version.get("dependencies") or ()
+            },
         )
-
-        processed_versions[version_number] = new_version
-
-    return processed_versions
+        for devops_version in devops_versions
+    }
 
 
 def get_extra_npm_info_from_devops_npm_registry(
@@ -154,14 +167,12 @@ def get_extra_npm_info_from_devops_npm_registry(
 
     npm_registry_url = f"{env_vars.npm_registry_base_url}/{package_name}"
 
-    devops_registry_response = get_from_devops(
-        npm_registry_url, env_vars, "DevOps NPM registry"
-    )
+    devops_registry_response = get_from_devops(npm_registry_url, "DevOps NPM registry")
 
     if isinstance(devops_registry_response, NetworkError):
         return devops_registry_response
 
-    devops_versions = devops_registry_response.json().get("versions")
+    devops_versions = orjson.loads(devops_registry_response.content).get("versions")
 
     updated_package_versions = {}
 
@@ -209,6 +220,36 @@ def get_extra_npm_info_from_devops_npm_registry(
     return updated_package_versions
 
 
+def get_package_versions_from_devops(
+    env_vars: EnvironmentalVariables,
+    package_name: str,
+    package_version_url: str,
+) -> tuple[
+    dict[str, NpmPackageVersion] | NetworkError,
+    dict[str, NpmPackageVersion] | NetworkError | None,
+]:
+    """
+    Get info for every version of a package from both the DevOps Artifact feed and
+    the DevOps NPM registry.
+
+    Returns the versions from the DevOps Artifact feed, and the versions with extra
+    info added from the DevOps NPM registry. The DevOps NPM registry is only queried
+    (i.e. the second value is only not `None`) if the DevOps Artifact feed returned
+    at least one version
+    """
+
+    feed_versions = get_npm_versions_from_devops_feed(package_version_url)
+
+    if isinstance(feed_versions, NetworkError) or len(feed_versions) == 0:
+        return feed_versions, None
+
+    registry_versions = get_extra_npm_info_from_devops_npm_registry(
+        env_vars, package_name, feed_versions
+    )
+
+    return feed_versions, registry_versions
+
+
 def validate_package_versions(
     package_name: str,
     package_versions: dict[str, NpmPackageVersion] | NetworkError,
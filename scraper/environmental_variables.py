@@ -111,5 +111,5 @@ def process_env_vars() -> EnvironmentalVariables:
         mongo_user=validate_env(ENV_MONGO_USER, "MongoDB username is required!"),
         mongo_pass=validate_env(ENV_MONGO_PASS, "MongoDB password is required!"),
         mongo_db=validate_env(ENV_MONGO_DB, "MongoDB database is required!"),
-        wipe_db=os.environ.get(ENV_WIPE_DB) is not None or False,
+        wipe_db=os.environ.get(ENV_WIPE_DB, "").lower() in ("1", "true", "yes"),
     )
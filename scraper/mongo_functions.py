@@ -1,13 +1,19 @@
 """Functions related to MongoDB"""
 
 import logging
+from typing import Final
 
-import dacite
-
-from pymongo import collection
+from pymongo import ReplaceOne, collection
 
 from enums import MongoPackageStatus
-from npm_classes import NpmPackage
+
+# Only the latest version is needed to check a package's status; don't pull every
+# version out of Mongo
+PACKAGE_STATUS_PROJECTION: Final[dict[str, int]] = {
+    "_id": 0,
+    "latest_version": 1,
+    "latest_view.name": 1,
+}
 
 
 def check_package_status_in_mongo(
@@ -21,35 +27,78 @@ def check_package_status_in_mongo(
     If it does, check if it is the latest version.
     """
 
-    mongo_package = packages_collection.find_one({"name": package_name})
+    mongo_package = packages_collection.find_one(
+        {"name": package_name}, PACKAGE_STATUS_PROJECTION
+    )
 
     if mongo_package is None:
         logging.info("Package '%s' not found in Mongo", package_name)
         return MongoPackageStatus.NOT_FOUND
 
-    try:
-        # Auto-magically convert dict to `npm_package`
-        found_package = dacite.from_dict(data_class=NpmPackage, data=mongo_package)
-    except dacite.WrongTypeError as err:
-        logging.error(
-            "Could not deserialise package '%s' from Mongo. Reason: %s",
-            package_name,
-            err,
+    # Packages uploaded by older versions of the scraper need to be re-uploaded
+    if "latest_view" not in mongo_package:
+        logging.info(
+            "Package '%s' has no latest version summary in Mongo", package_name
         )
-        return MongoPackageStatus.NOT_FOUND
+        return MongoPackageStatus.OUT_OF_DATE
 
-    if found_package.latest_version == package_latest_version:
+    mongo_latest_version = mongo_package.get("latest_version")
+
+    if mongo_latest_version == package_latest_version:
         logging.info(
             "Package '%s' has the same version (%s) in DevOps and Mongo",
-            found_package.name,
+            package_name,
             package_latest_version,
         )
         return MongoPackageStatus.UP_TO_DATE
 
     logging.info(
         "Package '%s' DevOps version (%s) is different to Mongo version (%s)",
-        found_package.name,
+        package_name,
         package_latest_version,
-        found_package.latest_version,
+        mongo_latest_version,
     )
     return MongoPackageStatus.OUT_OF_DATE
+
+
+def write_packages_to_mongo(
+    package_updates: list[ReplaceOne],
+    packages_collection: collection.Collection,
+):
+    """
+    Send all pending package uploads to Mongo in a single bulk write, then clear
+    `package_updates`
+    """
+
+    if len(package_updates) == 0:
+        return
+
+    logging.info("Uploading %s package(s) to Mongo", len(package_updates))
+
+    # Each package is a separate document, so the writes can happen in any order
+    packages_collection.bulk_write(package_updates, ordered=False)
+    package_updates.clear()
+
+
+def remove_duplicate_packages(packages_collection: collection.Collection):
+    """
+    Older versions of the scraper could upload the same package more than once.
+    Keep only the most recently uploaded copy of each package, so `name` can be
+    uniquely indexed
+    """
+
+    duplicates = packages_collection.aggregate(
+        [
+            {"$sort": {"_id": 1}},
+            {"$group": {"_id": "$name", "ids": {"$push": "$_id"}}},
+            {"$match": {"ids.1": {"$exists": True}}},
+        ]
+    )
+
+    for duplicate in duplicates:
+        logging.warning(
+            "Package '%s' is in Mongo %s times. Removing all but the latest copy",
+            duplicate["_id"],
+            len(duplicate["ids"]),
+        )
+        packages_collection.delete_many({"_id": {"$in": duplicate["ids"][:-1]}})